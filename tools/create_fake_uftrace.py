@@ -1,59 +1,107 @@
 #!/usr/bin/env python3
 
-import struct, shutil, subprocess, argparse
+import os, struct, shutil, subprocess, argparse
 from pathlib import Path
 
+verbose = True
+
+def log(val):
+    if verbose:
+        print(val)
+
+# header of the uftrace /info file: magic, version, header size, endian, elf class, feats, infos, mstack, reserved
+INFO_HEADER = struct.Struct("<8sIHBBQQH6s")
+
+# uftrace only loads function symbols from the .sym file, all other types are skipped
+SYMBOL_TYPES = b"tTwW"
+
+def write_symbols(binary, symfile):
+    """ writes the sorted function symbols of binary in `nm -n` format to symfile """
+
+    nm_cmd = ['nm', '-n', '--defined-only', binary]
+    with subprocess.Popen(nm_cmd, stdout=subprocess.PIPE, bufsize=1<<20) as nm, open(symfile, "wb", buffering=1<<20) as f:
+        for line in nm.stdout:
+            # lines look like `0000000000401000 T _start`
+            i = line.find(b" ")
+            if line[i+1:i+2] in SYMBOL_TYPES:
+                f.write(line)
+
+
+def copy_tracefile(src, dst):
+    """ copies the (potentially multi-GB) trace file, inside the kernel if possible """
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except (AttributeError, OSError):
+            # not supported by python, kernel or filesystem. Copy in userspace with large chunks instead
+            s.seek(0)
+            d.seek(0)
+            d.truncate()
+            shutil.copyfileobj(s, d, length=1<<20)
+
+
 def create_fake_uftrace(dirname, tracefile, binary=None, PID=123, TID=42, SID=b"00"):
     """ Creates a fake uftrace from just a trace.dat file + the original binary for symbols.
     other params can be chosen freely. Not really important, just cosmetics
     """
 
     print(f"Creating fake uftrace data dir at {dirname}..")
-    print("  Creating /info")
-    print("    feats = TASK_SESSION")
+    log("  Creating /info")
+    log("    feats = TASK_SESSION")
     TASK_SESSION = 1 << 1 # needed.
-    feats = struct.pack("<Q", TASK_SESSION)
+    feats = TASK_SESSION
 
-    print("    info = CMDLINE | TASKINFO")
+    log("    info = CMDLINE | TASKINFO")
     CMDLINE = 1 << 3 # needed, else --dump chrome outputs invalid json.
     TASKINFO = 1 << 7 # needed, since uftrace uses this to determine how to interpret task.txt
-    infos = struct.pack("<Q", CMDLINE | TASKINFO)
+    infos = CMDLINE | TASKINFO
     
-    print(f"    cmdline = 'fakeuftrace'")
-    print(f"    tid = {TID}")
+    log(f"    cmdline = 'fakeuftrace'")
+    log(f"    tid = {TID}")
 
     rest  = b"cmdline:fakeuftrace\n"
     rest += b"taskinfo:lines=2\n"
     rest += b"taskinfo:nr_tid=1\n"
     rest += b"taskinfo:tids=%d\n" % TID
 
-    magic = b"Ftrace!\x00"
-    version = b"\x04\x00\x00\x00" # we are using version 4 of fileformat
-    size = b"\x28\x00" # 0x28 == 40 bytes
-    endian = b"\x01"
-    classs = b"\x02" # elf_ident[EI_CLASS]. always 2 for 64bit
-    mstack = b"\x00\x00" # disabled feature
-    reserved = b"\x00"*6 # reverved, always 0
+    header = INFO_HEADER.pack(
+        b"Ftrace!\x00", # magic
+        4, # we are using version 4 of fileformat
+        INFO_HEADER.size, # 0x28 == 40 bytes
+        1, # endian
+        2, # elf_ident[EI_CLASS]. always 2 for 64bit
+        feats,
+        infos,
+        0, # mstack, disabled feature
+        b"", # reserved, always 0
+    )
 
     with open(f"{dirname}/info", "wb") as f:
-        f.write(magic+version+size+endian+classs+feats+infos+mstack+reserved+rest)
+        f.write(header)
+        f.write(rest)
 
     if binary:
         EXENAME = binary.split("/")[-1]
     else:
         EXENAME = "tracedguest"
 
-    print("  Creating /task.txt")
-    print(f"    pid = {PID}")
-    print(f"    sid = {SID.decode()}")
-    print(f"    exe = {EXENAME}")
+    log("  Creating /task.txt")
+    log(f"    pid = {PID}")
+    log(f"    sid = {SID.decode()}")
+    log(f"    exe = {EXENAME}")
     tasktxt  = b"SESS timestamp=0.0 pid=%d sid=%s exename=\"%s\"\n" % (PID, SID, EXENAME.encode())
     tasktxt += b"TASK timestamp=0.0 tid=%d pid=%d\n" % (TID, PID)
 
     with open(f"{dirname}/task.txt", "wb") as f:
         f.write(tasktxt)
 
-    print(f"  Creating /sid-{SID.decode()}.map memory map file")
+    log(f"  Creating /sid-{SID.decode()}.map memory map file")
     memmap  = b"000000000000-7f0000000000 r-xp 00000000 00:00 0                          %s\n" % EXENAME.encode()
     memmap += b"7f0000000000-7fffffffffff rw-p 00000000 00:00 0                          [stack]\n"
 
@@ -61,17 +109,15 @@ def create_fake_uftrace(dirname, tracefile, binary=None, PID=123, TID=42, SID=b"
         f.write(memmap)
 
     # copy trace data
-    print("  Copying trace file")
-    shutil.copyfile( tracefile , f"{dirname}/{TID}.dat" )
+    log("  Copying trace file")
+    copy_tracefile(tracefile, f"{dirname}/{TID}.dat")
 
     # generate symbols
     if binary:
-        print("  Generating symbols with nm")
-        nm_cmd = ['nm', '-n', binary]
-        with open(f"{dirname}/{EXENAME}.sym", "w") as symbolfile:
-            subprocess.run(nm_cmd, stdout=symbolfile)
+        log("  Generating symbols with nm")
+        write_symbols(binary, f"{dirname}/{EXENAME}.sym")
     else:
-        print("  No binary specified, not generating any symbols!")
+        log("  No binary specified, not generating any symbols!")
 
     print("Done!")
 
@@ -82,8 +128,11 @@ if __name__ == "__main__":
     parser.add_argument("TRACE", help="path to one or more guest trace files, as output by the tracing crate")
     parser.add_argument("OUTPUT", help="file or folder where output gets stored")
     parser.add_argument("-b", "--binary", help="path to guest binary, used to generate the symbols of the guest trace")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the most important messages")
     args = parser.parse_args()
 
+    verbose = not args.quiet
+
     Path(args.OUTPUT).mkdir(parents=True, exist_ok=True)
     create_fake_uftrace(args.OUTPUT, args.TRACE, args.binary)
     print(f"You can view a replay of the trace with `uftrace replay -d {args.OUTPUT}`")
\ No newline at end of file
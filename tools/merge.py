@@ -1,25 +1,112 @@
 #!/usr/bin/env python3
 
-import json, struct, shutil, tempfile, subprocess, re, sys, argparse
+import os, json, struct, shutil, tempfile, subprocess, re, sys, argparse, itertools, mmap, concurrent.futures
 from pathlib import Path
 
+from create_fake_uftrace import create_fake_uftrace, write_symbols
+from perfetto_trace import write_perfetto_trace
+
+# orjson is a lot faster and memory friendlier on large traces, but not always installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ujson is still faster than the stdlib json, if orjson is not available
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# ijson lets us parse the uftrace output while it is still being generated
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# numpy is used to vectorize the per-event timestamp arithmetic
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# pandas parses the perf counter tables in C
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
 verbose = True
 
 def log(val):
     if verbose:
         print(val)
 
+def set_verbose(value):
+    # worker processes do not necessarily inherit our globals, so they get the flag passed explicitly
+    global verbose
+    verbose = value
+
 UFTRACE_PATH = "uftrace"
 
+# matches the tracing line where the tsc offset of the vm gets set
+TSC_OFFSET_RE = re.compile(r"kvm_write_tsc_offset.*next=(\d+)")
+
+# matches timestamp and name of a trace-cmd report line
+TRACECMD_EVENT_RE = re.compile(rb"\[\d{3}\] (\d+): (\S+):")
+# lines of the trace-cmd report we look at to find the first kvm event
+TRACECMD_HEADER_MAX = 200
+
+# phases of the kvm events, stored as index into KVM_PHASES while parsing
+PH_BEGIN, PH_END, PH_DURATION = range(3)
+KVM_PHASES = ("B", "E", "X")
+
+# matches the `time: event:` lines of perf script
+PERF_EVENT_RE = re.compile(rb"^ *(\d+\.\d+):? +(.*?):? *$", re.MULTILINE)
+
+def intern_names(events):
+    """ makes all events with the same name share one string object
+
+    traces only have a few distinct function names, repeated for every entry and exit
+    """
+
+    for e in events:
+        name = e.get('name')
+        if name is not None:
+            e['name'] = sys.intern(name)
+
+
 def parse_uftrace(uftracedir):
     """ parses uftrace trace to get chrome json file """
 
     print(f"Converting traces from {uftracedir}")
     uftrace_cmd = [UFTRACE_PATH, 'dump', "--chrome"]
 
-    js = subprocess.check_output(uftrace_cmd, cwd=uftracedir)
-    trace = json.loads(js)
+    if not ijson:
+        if orjson:
+            # let uftrace write into a temp file and parse it memory mapped. This way the raw json lives in
+            # the page cache, which the kernel can evict, instead of a python bytes object
+            with tempfile.TemporaryFile() as tf:
+                subprocess.check_call(uftrace_cmd, cwd=uftracedir, stdout=tf)
+                with mmap.mmap(tf.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as js:
+                    trace = orjson.loads(js)
+        else:
+            # fall back to buffering the whole output, which needs a lot of memory for large traces
+            trace = json.loads(subprocess.check_output(uftrace_cmd, cwd=uftracedir))
+
+        intern_names(trace['traceEvents'])
+        return trace
+
+    if ijson.backend == 'python':
+        print("Warning: ijson only has its pure python backend available, parsing will be slow. Install yajl2 for the C backend.")
 
+    # stream the json directly from uftrace, so the raw output never has to be kept in memory
+    with subprocess.Popen(uftrace_cmd, cwd=uftracedir, stdout=subprocess.PIPE, bufsize=1<<20) as proc:
+        trace = dict(ijson.kvitems(proc.stdout, '', use_float=True))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, uftrace_cmd)
+
+    intern_names(trace['traceEvents'])
     return trace
 
 
@@ -36,74 +123,211 @@ def parse_perf_trace(perf_trace_file):
     """
 
     perf_cmd = ['perf', 'script', '-F', 'trace:time,event', '--ns', '-i', perf_trace_file]
-    events = subprocess.check_output(perf_cmd).split(b"\n")
-    print(f"Parsing {len(events)} KVM events")
-    out = [{'pid':1, 'ts':int(e[:15].replace(b".",b""))/1000, 'ph':'i','name':e[16:-2].strip().decode()} for e in events if e]
-    return out
+    with subprocess.Popen(perf_cmd, stdout=subprocess.PIPE, bufsize=1<<20) as perf:
+        if not np:
+            # go through the output line by line instead of splitting one huge buffer
+            out = []
+            names = {}
+            for e in perf.stdout:
+                m = PERF_EVENT_RE.match(e)
+                if m:
+                    ts, name = m.groups()
+                    # only decode each distinct event name once
+                    decoded = names.get(name)
+                    if decoded is None:
+                        decoded = names[name] = sys.intern(name.decode())
+                    out.append({'pid':1, 'ts':int(ts.replace(b".",b""))/1000, 'ph':'i', 'name':decoded})
+        else:
+            # let numpy scan the whole output and convert all timestamps at once
+            parsed = np.fromregex(perf.stdout, PERF_EVENT_RE, dtype=[('ts', 'S32'), ('name', 'S64')])
+    if perf.returncode != 0:
+        raise subprocess.CalledProcessError(perf.returncode, perf_cmd)
+
+    if not np:
+        print(f"Parsed {len(out)} KVM events")
+        return out
+
+    print(f"Parsed {len(parsed)} KVM events")
+    ts = np.char.replace(parsed['ts'], b".", b"").astype(np.int64) / 1000
+    # names stay bytes in the array, only the few distinct ones are decoded
+    raw_names, name_idx = np.unique(parsed['name'], return_inverse=True)
+    names = [sys.intern(name.decode()) for name in raw_names.tolist()]
+    return [{'pid':1, 'ts':t, 'ph':'i', 'name':names[i]} for t, i in zip(ts.tolist(), name_idx.tolist())]
+
+
+def read_line_blocks(f, size=1<<20):
+    """ reads f in blocks of roughly size bytes, which always end at a line boundary """
+
+    rest = b""
+    while True:
+        block = f.read(size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        end = block.rfind(b"\n") + 1
+        if end == 0:
+            rest += block
+            continue
+        yield rest + block[:end]
+        rest = block[end:]
 
 
-def parse_tracecmd_trace(trace_cmd_trace_file):
-    """ parses a trace-cmd recording of kvm-events
+def parse_tracecmd_columns(trace_cmd_trace_file):
+    """ parses a trace-cmd recording of kvm-events into (ts, phase, name) columns
 
     sudo trace-cmd record -e 'kvm:*' -C x86-tsc
     """
 
     print(f"Parsing kvm traces from {trace_cmd_trace_file}")
 
-    # the full kvmtrace can easily be >1gb file. Even with sed as filtering we get ~4gb output.
-
-    trace_cmd = ['trace-cmd', 'report', '-q', '-i', trace_cmd_trace_file]
-    trace = subprocess.Popen(trace_cmd, stdout=subprocess.PIPE)
-    
-    # align so that we have csv of time,func. Sed is faster and memory friendlier than python here
+    # the full kvmtrace can easily be >1gb file, the report of it even multiple times that.
+    # we only need time and name of each event, which are matched directly on the report lines:
     #   <...>-105662 [002] 117471684343752: kvm_update_master_clock: masterclock 0 hostclock tsc offsetmatched 0
     #   qemu-system-x86-20667 [010] 15813659115036: kvm_exit:             reason EXIT_IOIO rip 0xec08e info cf80140 ec08f
-    sed = ['sed', '-E', r's/.*\[[0-9][0-9][0-9]] ([^ ]*): ([^ ]*):.*/\1,\2/']
-    events = subprocess.check_output(sed, stdin = trace.stdout).split(b"\n")
-    trace.wait()
-
-    log("events like:")
-    log(events[:10])
-
-    # cut off header
-    offset = next(i for i,e in enumerate(events) if b"kvm_" in e)
-    
+    trace_cmd = ['trace-cmd', 'report', '-q', '-i', trace_cmd_trace_file]
+    trace = subprocess.Popen(trace_cmd, stdout=subprocess.PIPE, bufsize=1<<20)
+
+    # cut off header. it is only a few lines, so never scan a malformed report to its end
+    head = []
+    for e in itertools.islice(trace.stdout, TRACECMD_HEADER_MAX):
+        if b"kvm_" in e:
+            break
+        head.append(e)
+    else:
+        trace.kill()
+        trace.wait()
+        raise ValueError(f"No kvm events in the first {TRACECMD_HEADER_MAX} lines of {trace_cmd_trace_file}")
+    log("header like:")
+    log(head[:10])
     log('events look like:')
-    log(events[offset])
+    log(e)
 
-    print(f"Parsing {len(events)} KVM events")
-    out = []
+    # collect columns in the hot loop and only build the event dicts at the end
+    ts_col = []
+    ph_col = []
+    name_col = []
+    names = {}
     in_kvm = True # first event will be a "begin" function event, so we dont get broken frames
-    for e in events[offset:]:
-        pts = e.strip().split(b",")
-        if len(pts) < 2:
-            continue
-        #name = pts[3][:-1].decode()
-        #ts = int(pts[2][:-1])
-        ts = int(pts[0]) / 1000.0 
-        name = pts[1].decode()
-        # make kvm-exit and entry special, so we see the time it is exited. all others get 300ns duration bars
-        if name == "kvm_exit" and in_kvm:
-            tp = "B" # entry to kvm-host
-            name = "kvm exited"
-            in_kvm = False
-        elif name == "kvm_entry" and not in_kvm:
-            tp = "E" # exit from kvm-host
-            name = "kvm exited"
-            in_kvm = True
-        else:
-            tp = "X" # generic kvm event.
-        
-        out.append({
-            'pid':77,
-            'tid':77,
-            'ts':ts,
-            'ph':tp, # i = instant event, too small to see.. X = duration event
-            'dur':0.3, # gets ignored if we are in entry/exit case
-            'name': name
-        })
+    # the rest of the output is matched in large blocks, so the regex engine runs over many lines per call
+    for block in itertools.chain([e], read_line_blocks(trace.stdout)):
+        for ts, name in TRACECMD_EVENT_RE.findall(block):
+            # make kvm-exit and entry special, so we see the time it is exited. all others get 300ns duration bars
+            if name == b"kvm_exit" and in_kvm:
+                ph = PH_BEGIN # entry to kvm-host
+                name = "kvm exited"
+                in_kvm = False
+            elif name == b"kvm_entry" and not in_kvm:
+                ph = PH_END # exit from kvm-host
+                name = "kvm exited"
+                in_kvm = True
+            else:
+                ph = PH_DURATION # generic kvm event.
+                # there are only a handful of distinct names, so decode each once and share the str
+                decoded = names.get(name)
+                if decoded is None:
+                    decoded = names[name] = sys.intern(name.decode())
+                name = decoded
+
+            ts_col.append(int(ts))
+            ph_col.append(ph)
+            name_col.append(name)
+
+    # close the last kvm exit if we never saw the entry, so the kvm events are always balanced
+    if not in_kvm:
+        ts_col.append(ts_col[-1])
+        ph_col.append(PH_END)
+        name_col.append("kvm exited")
 
-    return out
+    if trace.wait() != 0:
+        raise subprocess.CalledProcessError(trace.returncode, trace_cmd)
+    print(f"Parsed {len(ts_col)} KVM events")
+
+    return ts_col, ph_col, name_col
+
+
+def tracecmd_events(ts_col, ph_col, name_col):
+    """ builds the chrome trace events from the columns of parse_tracecmd_columns """
+
+    return [{
+        'pid':77,
+        'tid':77,
+        'ts':ts / 1000.0,
+        'ph':KVM_PHASES[ph], # i = instant event, too small to see.. X = duration event
+        'dur':0.3, # gets ignored if we are in entry/exit case
+        'name': name
+    } for ts, ph, name in zip(ts_col, ph_col, name_col)]
+
+
+def parse_tracecmd_trace(trace_cmd_trace_file):
+    """ parses a trace-cmd recording of kvm-events """
+
+    return tracecmd_events(*parse_tracecmd_columns(trace_cmd_trace_file))
+
+
+def shift_and_scale(events, shift=0, scale=1.0, span=None):
+    """ subtracts shift from all positive timestamps, then multiplies every timestamp by scale
+
+    if span=(start, end) is given, only events with start <= ts <= end after conversion are kept.
+    returns the resulting list of events
+    """
+
+    if not np:
+        kept = []
+        for event in events:
+            if event['ts'] > 0:
+                event['ts'] -= shift
+            elif shift:
+                log(f"Not offsetting: {event}")
+            event['ts'] *= scale
+            if span is None or span[0] <= event['ts'] <= span[1]:
+                kept.append(event)
+        return kept
+
+    # work on a contiguous array of timestamps instead of touching every dict twice
+    ts = np.fromiter((e['ts'] for e in events), dtype=np.float64, count=len(events))
+    positive = ts > 0
+    if shift:
+        ts[positive] -= shift
+        for i in np.flatnonzero(~positive).tolist():
+            log(f"Not offsetting: {events[i]}")
+    ts *= scale
+
+    if span is not None:
+        keep = np.flatnonzero((ts >= span[0]) & (ts <= span[1]))
+        events = [events[i] for i in keep.tolist()]
+        ts = ts[keep]
+
+    for event, t in zip(events, ts.tolist()):
+        event['ts'] = t
+    return events
+
+
+def filter_timespan(events, start, end):
+    """ returns all events with start <= ts <= end """
+
+    if not np:
+        return list(filter(lambda e: e['ts'] >= start and e['ts'] <= end, events))
+
+    ts = np.fromiter((e['ts'] for e in events), dtype=np.float64, count=len(events))
+    keep = np.flatnonzero((ts >= start) & (ts <= end))
+    return [events[i] for i in keep.tolist()]
+
+
+def first_timestamp(events):
+    """ returns the smallest positive timestamp of events """
+
+    if not np:
+        first = min(events, key=lambda x: x['ts'] if x['ts'] > 0 else 999999999999999, default=None)
+        if first is None:
+            raise ValueError("No events to take a first timestamp from!")
+        return first['ts']
+
+    ts = np.fromiter((e['ts'] for e in events), dtype=np.float64)
+    if not ts.size:
+        raise ValueError("No events to take a first timestamp from!")
+    # non-positive timestamps never win, same as in the fallback
+    return ts[np.argmin(np.where(ts > 0, ts, np.inf))].item()
 
 
 def get_offset():
@@ -134,8 +358,8 @@ def get_offset():
         
         # if any method suceeded in getting tsc log line, parse timestamp
         if last_tsc:
-            r = re.search(r"kvm_write_tsc_offset.*next=(\d*)", last_tsc)
-            if len(r.groups()) == 0:
+            r = TSC_OFFSET_RE.search(last_tsc)
+            if not r:
                 print(f"Cannot parse correct offset from tracing: {last_tsc}!")
                 sys.exit(-1)
             offset_raw = int(r.groups()[0])
@@ -156,19 +380,19 @@ def get_offset():
 def fixup_tids(trace, target_tid):
     # if an event has no tid, set it to target_tid
     for e in trace['traceEvents']:
-        if not "tid" in e:
-            e['tid'] = target_tid
+        e.setdefault('tid', target_tid)
 
 
-def fixup_missing_starts(trace, fts, lts):
-    # go through trace backwards, keep track of current function stack
-    # everytime we pass exit, we push onto stack, on entry we pop again
+def fixup_missing_starts(events, fts, lts):
+    # go through trace, keep track of current function stack
+    # everytime we pass an entry, we push onto stack, on exit we pop again
     # we have separate stacks for each tid/pid pair!
 
-    new_events = []
     stacks = {}
-    for e in trace['traceEvents'][::-1]:
-        if e['ph'] not in ['E', 'B']:
+    missing = {} # exits without entry, in the order we saw them, so innermost first
+    for e in events:
+        ph = e['ph']
+        if ph != 'B' and ph != 'E':
             # only affects entry and exit events
             continue
         
@@ -178,30 +402,38 @@ def fixup_missing_starts(trace, fts, lts):
         
         key = (e['pid'], e['tid'])
         # get stack or set if not exists yet
-        stack = stacks.setdefault(key, [])
+        stack = stacks.get(key)
+        if stack is None:
+            stack = stacks[key] = []
 
-        if e['ph'] == "E": # exit
+        if ph == "B": # entry
             stack.append(e['name'])
-        elif e['ph'] == "B": # entry
-            if len(stack) > 0:
-                func = stack.pop()
-                if(e['name'] != func):
-                    log(f"Callstack misaligned! expected {func} got")
-                    log(e)
-            else:
-                log("Entered function which we never exited!")
+        elif len(stack) > 0: # exit
+            func = stack.pop()
+            if(e['name'] != func):
+                log(f"Callstack misaligned! expected {func} got")
                 log(e)
-                new_events.append({
-                    'pid':e['pid'],
-                    'tid':e['tid'],
-                    'ts':lts,
-                    'ph':"E",
-                    'name': e['name']
-                })
+        else:
+            log("Exited function which we never entered!")
+            log(e)
+            missing.setdefault(key, []).append(e['name'])
 
+    # all synthesized events of a thread share one timestamp, so viewers nest them by their order.
+    # close the open frames innermost first, and open the missing ones outermost first
+    new_events = []
     for (pid, tid), names in stacks.items():
-        for name in names:
-            log(f"Exited function which we never entered: {name}!")
+        for name in reversed(names):
+            log(f"Entered function which we never exited: {name}!")
+            new_events.append({
+                'pid':pid,
+                'tid':tid,
+                'ts':lts,
+                'ph':"E",
+                'name': name
+            })
+
+    for (pid, tid), names in missing.items():
+        for name in reversed(names):
             new_events.append({
                 'pid':pid,
                 'tid':tid,
@@ -211,7 +443,7 @@ def fixup_missing_starts(trace, fts, lts):
             })
 
     log(new_events)
-    trace['traceEvents'] += new_events
+    return new_events
 
 
 # parses the counters output by perf with a command like
@@ -222,26 +454,57 @@ def parse_perf_counters(filename, starttime, conversion_fac):
     #  15.127678049#114116639##cycles:G#107341775#100.00##
     #  15.127678049#31961##kvm:kvm_exit#107369492#100.00##
 
+    if os.path.getsize(filename) == 0:
+        # an empty file cannot be mapped, and has no rdtsc line or counters anyways
+        print("No accurate timestamp alignment possible for perf counters! They will likely be offset by some tens of ms.")
+        return []
+
     new_events = []
-    with open(filename, "r") as f:
+    # the counter file is mapped instead of read, so large files are only paged in by the kernel as needed
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
         # try to get better rdtsc, if one is available in counter file.
-        head = f.readline()
-        if "rdtsc" in head:
+        head = buf.readline()
+        if b"rdtsc" in head:
             # we have to adjust start time to seconds here, since perf counters already is in seconds since start!
-            starttime = int(head.split(" ")[1])/1000 * conversion_fac
+            starttime = int(head.split(b" ")[1])/1000 * conversion_fac
             log(f"Updated perf start time from rdtsc-line to {starttime}")
-            f.readline() # also skip next line. this is the usual file header
+            buf.readline() # also skip next line. this is the usual file header
         else:
             print("No accurate timestamp alignment possible for perf counters! They will likely be offset by some tens of ms.")
 
-        for line in f.readlines()[1:]:
-            fields = line.strip().split('#')
-            if "not counted" in fields[1]:
+        if pd:
+            # fields are time#count##name#runtime#percentage##, with count possibly `<not counted>`
+            try:
+                df = pd.read_csv(buf, sep='#', header=None, skiprows=1, usecols=[0, 1, 3, 5], dtype={1: str}, float_precision='round_trip')
+            except pd.errors.EmptyDataError:
+                # perf stat ended before the first sample
+                return []
+            # could not sample here? Just skip them..
+            df = df[~df[1].str.contains("not counted")]
+
+            # upscale count by counter_percentage
+            counts = df[1].astype("int64") / (df[5] / 100.0)
+            ts = starttime + df[0]*1000000 # convert to us
+            return [{
+                'pid': 1,
+                'ts': t,
+                'ph': "C",
+                'name': name,
+                'args': {name:count},
+            } for t, name, count in zip(ts.tolist(), df[3].tolist(), counts.tolist())]
+
+        buf.readline()
+        names = {}
+        for line in iter(buf.readline, b""):
+            fields = line.strip().split(b'#')
+            if b"not counted" in fields[1]:
                 # could not sample here? Just continue..
                 continue
             time = float(fields[0])
             count = int(fields[1])
-            name = fields[3]
+            name = names.get(fields[3])
+            if name is None:
+                name = names[fields[3]] = fields[3].decode()
             counter_runtime = int(fields[4])
             counter_percentage = float(fields[5]) # time the counter was running if limited available
 
@@ -259,6 +522,30 @@ def parse_perf_counters(filename, starttime, conversion_fac):
     return new_events
 
 
+def save_trace(trace, filename):
+    """ writes trace as chrome json file, one event at a time, so the whole json never has to be in memory """
+
+    if orjson:
+        dumps = orjson.dumps
+    elif ujson:
+        dumps = lambda obj: ujson.dumps(obj).encode()
+    else:
+        dumps = lambda obj: json.dumps(obj).encode()
+
+    with open(filename, 'wb', buffering=1<<20) as f:
+        # all other top level keys first, then leave the object open for the event list
+        head = dumps({k: v for k, v in trace.items() if k != 'traceEvents'})
+        f.write(head[:-1])
+        if len(head) > 2:
+            f.write(b",")
+        f.write(b'"traceEvents":[')
+        for i, e in enumerate(trace['traceEvents']):
+            if i:
+                f.write(b",")
+            f.write(dumps(e))
+        f.write(b"]}")
+
+
 def merge():
     # determine the timestamp offset of the guest vm
     offset = get_offset()
@@ -266,37 +553,30 @@ def merge():
     # if binary is specified, generate symbols for trace
     if args.binary:
         print("Generating symbols with nm")
-        nm_cmd = ['nm', '-n', args.binary]
-        with open(f"{args.TRACE}/{args.binaryname}.sym", "w") as symbolfile:
-            subprocess.run(nm_cmd, stdout=symbolfile)
+        write_symbols(args.binary, f"{args.TRACE}/{args.binaryname}.sym")
     else:
         print("No binary specified, not generating any symbols!")
 
-    hermit_trace = parse_uftrace(args.TRACE)
-    
-    if args.merge:
-        merge_trace = parse_uftrace(args.merge)
-        # uftrace might not include tid data, which will crash the tracy importer.
-        # fix up now
-        fixup_tids(merge_trace, 1234)
-    else:
-        merge_trace = None
-
-    if offset:
-        print(f"Offseting guest traces by {offset} counts")
-        
-        for event in hermit_trace["traceEvents"]:
-            if event['ts'] > 0:
-                event['ts'] -= offset/1000
-            else:
-                print("Not offsetting:", event)
+    # all sources are independent and mostly wait on their external tool, so parse them concurrently
+    # the kvm parse loop is pure python and would hold the GIL against the other parsers, so it gets its own process.
+    # only the plain columns are sent back, which is much cheaper than pickling millions of event dicts
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=set_verbose, initargs=(verbose,)) as procs, concurrent.futures.ThreadPoolExecutor() as pool:
+        # perf/kvm traces
+        if args.kvm:
+            kvm_future = procs.submit(parse_tracecmd_columns, args.kvm)
+        if perf_kvm_trace:
+            perf_future = pool.submit(parse_perf_trace, perf_kvm_trace)
+        hermit_future = pool.submit(parse_uftrace, args.TRACE)
+        if args.merge:
+            merge_future = pool.submit(parse_uftrace, args.merge)
+
+        perf_events = perf_future.result() if perf_kvm_trace else None
+        if args.kvm:
+            kvm_events = tracecmd_events(*kvm_future.result())
+        hermit_trace = hermit_future.result()
+        merge_trace = merge_future.result() if args.merge else None
 
-    # perf/kvm traces
-    if perf_kvm_trace:
-        kvm_events = parse_perf_trace(perf_kvm_trace)
     if args.kvm:
-        kvm_events = parse_tracecmd_trace(args.kvm)
-
         # get first and last timestamp of our trace-cmd trace. Not the best but seems to work
         # needed later to fix some stuff up, like aligning perf stat samples.
         lts = kvm_events[-1]['ts']
@@ -306,41 +586,70 @@ def merge():
         lts = None
         fts = None
 
-
-    # merging
-    print("Merging traces")
-    out = hermit_trace
-
     if merge_trace:
-        out['traceEvents'] += merge_trace['traceEvents']
-    if args.kvm:
-        out['traceEvents'] += kvm_events
+        # uftrace might not include tid data, which will crash the tracy importer.
+        # fix up now
+        fixup_tids(merge_trace, 1234)
 
     # TSC -> ns conversion
     tsc_khz = args.freq
     if tsc_khz:
         conversion_fac = 1000000.0/tsc_khz * time_stretch
         print(f"Converting time to ns with tsc_khz={tsc_khz}")
-        for event in out["traceEvents"]:
-            event['ts'] *= conversion_fac
         if time_stretch != 1:
             print(f"Time is off by a factor of {time_stretch}!")
+    else:
+        conversion_fac = 1.0
 
+    if args.kvm:
         # also adapt first/last trace-cmd timestamps
         fts *= conversion_fac
         lts *= conversion_fac
 
+    # filter out unrelevant traces (outside of qemu runtime) if specified.
+    # this happens in the same pass as offset and time conversion, so every event is only touched once
+    span = None
+    if args.filter:
+        if not args.kvm:
+            print("ERROR: You have to specify a kvm trace to filter! Ignoring option.")
+        else:
+            span = (fts, lts)
+
+    if offset:
+        print(f"Offseting guest traces by {offset} counts")
+    if offset or tsc_khz or span:
+        hermit_trace["traceEvents"] = shift_and_scale(hermit_trace["traceEvents"], shift=offset/1000, scale=conversion_fac, span=span)
+    if merge_trace and (tsc_khz or span):
+        merge_trace["traceEvents"] = shift_and_scale(merge_trace["traceEvents"], scale=conversion_fac, span=span)
+    # kvm events define the span, so they never need filtering
+    if args.kvm and tsc_khz:
+        shift_and_scale(kvm_events, scale=conversion_fac)
+
+    # merging. all event lists are only collected here and concatenated once while saving,
+    # so the (potentially huge) lists are never copied around
+    print("Merging traces")
+    sources = [hermit_trace['traceEvents']]
+
+    if merge_trace:
+        sources.append(merge_trace['traceEvents'])
+    # everything after the uftrace events is balanced already
+    uftrace_sources = list(sources)
+    if args.kvm:
+        sources.append(kvm_events)
+
     # add perf traces after time conversion, since they are already in ns
     if perf_kvm_trace:
         if not tsc_khz:
             print("Error: perf is nanosecond aligned -> need to specify tsc_khz for conversion!")
             sys.exit(-1)
-        out['traceEvents'] += kvm_events
+        if span:
+            perf_events = filter_timespan(perf_events, *span)
+        sources.append(perf_events)
 
     # get first timestamp if still missing. will misalign?
     if not fts:
         print("Using hacky first/last timestamp method. This will likely misalign counters?")
-        fts = min(out['traceEvents'], key=lambda x: x['ts'] if x['ts'] > 0 else 999999999999999)['ts']
+        fts = first_timestamp(itertools.chain.from_iterable(sources))
         log(f"Got fts as {fts}")
 
     # perf stat trace
@@ -352,21 +661,26 @@ def merge():
         # seems to be offset by around 50ms, so just correct for this.
         # this gets overwritten if we provide an 'rdtsc ' line in the perf counter file! 
         kvm_start_offset = 50000
-        out['traceEvents'] += parse_perf_counters(args.perf, fts-kvm_start_offset, conversion_fac)
+        counters = parse_perf_counters(args.perf, fts-kvm_start_offset, conversion_fac)
+        if span:
+            counters = filter_timespan(counters, *span)
+        sources.append(counters)
 
-    # filter out unrelevant traces (outside of qemu runtime) if specified.
-    if args.filter:
-        if not args.kvm:
-            print("ERROR: You have to specify a kvm trace to filter! Ignoring option.")
-        else:
-            out['traceEvents'] = list(filter(lambda e: e['ts'] >= fts and e['ts'] <= lts, out['traceEvents']))
-    
     print('Fixing missing start entries if necessary')
-    fixup_missing_starts(out, fts, lts)
+    # kvm events are balanced by construction and perf events have no frames at all,
+    # so only the uftrace events need to be checked
+    sources.append(fixup_missing_starts(itertools.chain.from_iterable(uftrace_sources), fts, lts))
+
+    out = hermit_trace
+    out['traceEvents'] = itertools.chain.from_iterable(sources)
 
     print(f"Saving merged trace to {args.OUTPUT}!")
-    with open(args.OUTPUT, 'w') as f:
-        json.dump(out, f)
+    if args.format == "perfetto":
+        skipped = write_perfetto_trace(list(out['traceEvents']), args.OUTPUT)
+        if skipped:
+            print(f"Skipped {skipped} events which cannot be represented in a perfetto trace")
+    else:
+        save_trace(out, args.OUTPUT)
 
 def do_uftrace():
     print(f"uftrace mode, ignoring most options!")
@@ -389,10 +703,14 @@ if __name__ == "__main__":
     parser.add_argument("-k", "--kvm", help="path to the trace-cmd trace of kvm samples (trace-cmd record -e 'kvm:*' -C x86-tsc)")
     parser.add_argument("-f", "--freq", help="TSC frequency in khz. This is approx. your cpu frequency. If specified, outputs timestamps into nanoseconds.", type=float)
     parser.add_argument("-F", "--filter", action="store_true", help="filter out all events which happened before kvm started. Need to specify kvm trace!")
+    parser.add_argument("--format", choices=["json", "perfetto"], default="json", help="output format. perfetto protobuf traces are a lot smaller and faster to load than json for large traces")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the most important messages")
     parser.add_argument("-p", "--perf", help="Additional perf stat file for graphs in trace. (perf stat -I 100 -e cycles:G -x\#)")
 
     args = parser.parse_args()
 
+    verbose = not args.quiet
+
     # perf KVM Traces have unreliable timestamps, not exposed via argument
     perf_kvm_trace = None
 
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import subprocess, argparse
+
+verbose = True
+
+def log(val):
+    if verbose:
+        print(val)
+
+
+def perf_record(pid, duration, output, freq=99, guest=False, binary=None):
+    """ samples the running process pid with perf for duration seconds
+
+    Unlike the gdb based poor mans profiler, the process is never stopped, the samples are taken by the PMU.
+    For a qemu process, guest=True samples the guest instead. perf only records the guest ip there, no callchain!
+    """
+
+    if guest:
+        perf_cmd = ['perf', 'kvm', '--guest', '-o', output]
+        if binary:
+            # hermit is linked into a single binary, so we can use it like a guest kernel to resolve symbols
+            perf_cmd += [f'--guestvmlinux={binary}']
+        perf_cmd += ['record']
+    else:
+        perf_cmd = ['perf', 'record', '-g', '-o', output]
+    perf_cmd += ['-F', str(freq), '-p', str(pid), '--', 'sleep', str(duration)]
+
+    print(f"Sampling {pid} with {freq}Hz for {duration}s")
+    log(" ".join(perf_cmd))
+    subprocess.check_call(perf_cmd)
+    print(f"Done! Samples stored in {output}")
+
+
+def perf_report(output, guest=False):
+    if guest:
+        report_cmd = ['perf', 'kvm', '--guest', '-i', output, 'report', '--stdio']
+    else:
+        report_cmd = ['perf', 'report', '--stdio', '-i', output]
+    subprocess.check_call(report_cmd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sampling profiler for a running process (like qemu), based on perf record. Replaces the gdb/lldb poor mans profiler where no guest backtraces are needed.')
+
+    parser.add_argument("PID", type=int, help="pid of the process to sample, for example $(pgrep qemu-system)")
+    parser.add_argument("-d", "--duration", type=float, help="how many seconds to sample", default=60)
+    parser.add_argument("-F", "--freq", type=int, help="sampling frequency in Hz", default=99)
+    parser.add_argument("-o", "--output", help="perf data file", default="perf.data")
+    parser.add_argument("-g", "--guest", action="store_true", help="sample the kvm guest instead of the process itself. Only records instruction pointers!")
+    parser.add_argument("-b", "--binary", help="path to guest binary, used to resolve guest symbols with --guest")
+    parser.add_argument("-r", "--report", action="store_true", help="print perf report after sampling")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the most important messages")
+    args = parser.parse_args()
+
+    verbose = not args.quiet
+
+    perf_record(args.PID, args.duration, args.output, args.freq, args.guest, args.binary)
+    if args.report:
+        perf_report(args.output, args.guest)
+    elif args.guest:
+        print(f"You can view the samples with `perf kvm --guest -i {args.output} report`")
+    else:
+        print(f"You can view the samples with `perf report -i {args.output}`, or render a flamegraph from `perf script -i {args.output}`")
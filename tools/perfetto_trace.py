@@ -0,0 +1,192 @@
+""" Writes chrome trace events as a binary perfetto trace.
+
+Only the handful of protobuf messages we need are encoded by hand, so neither protoc nor the
+perfetto protos are needed. Field numbers are taken from perfetto's protos/perfetto/trace/*.proto
+"""
+
+import struct
+
+# TracePacket
+PACKET_TIMESTAMP = 8
+PACKET_SEQUENCE_ID = 10
+PACKET_TRACK_EVENT = 11
+PACKET_INTERNED_DATA = 12
+PACKET_SEQUENCE_FLAGS = 13
+PACKET_TRACK_DESCRIPTOR = 60
+
+SEQ_INCREMENTAL_STATE_CLEARED = 1
+SEQ_NEEDS_INCREMENTAL_STATE = 2
+
+# TrackEvent
+EVENT_TYPE = 9
+EVENT_NAME_IID = 10
+EVENT_TRACK_UUID = 11
+EVENT_DOUBLE_COUNTER_VALUE = 44
+
+TYPE_SLICE_BEGIN = 1
+TYPE_SLICE_END = 2
+TYPE_INSTANT = 3
+TYPE_COUNTER = 4
+
+# TrackDescriptor, ProcessDescriptor, ThreadDescriptor
+TRACK_UUID = 1
+TRACK_NAME = 2
+TRACK_PROCESS = 3
+TRACK_THREAD = 4
+TRACK_PARENT_UUID = 5
+TRACK_COUNTER = 8
+PROCESS_PID = 1
+PROCESS_NAME = 6
+THREAD_PID = 1
+THREAD_TID = 2
+THREAD_NAME = 5
+
+# InternedData, EventName
+INTERNED_EVENT_NAMES = 2
+EVENT_NAME_IID_FIELD = 1
+EVENT_NAME_NAME = 2
+
+SEQUENCE_ID = 1
+
+DOUBLE = struct.Struct("<d")
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def field_varint(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def field_bytes(field, data):
+    if isinstance(data, str):
+        data = data.encode()
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+
+def field_double(field, value):
+    return varint(field << 3 | 1) + DOUBLE.pack(value)
+
+
+class PerfettoWriter:
+    """ keeps track of the tracks and interned names of a single packet sequence """
+
+    def __init__(self, f, process_names, thread_names):
+        self.f = f
+        self.process_names = process_names
+        self.thread_names = thread_names
+        self.tracks = {}
+        self.names = {}
+        self.first = True
+
+    def packet(self, payload):
+        # the file is a `Trace` message, which is just a list of TracePackets in field 1
+        self.f.write(field_bytes(1, payload))
+
+    def track(self, key, descriptor):
+        """ returns uuid of the track, emitting its descriptor on first use """
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = len(self.tracks) + 1
+            self.packet(field_bytes(PACKET_TRACK_DESCRIPTOR, field_varint(TRACK_UUID, uuid) + descriptor(uuid)))
+        return uuid
+
+    def process_track(self, pid):
+        def descriptor(uuid):
+            process = field_varint(PROCESS_PID, pid)
+            if pid in self.process_names:
+                process += field_bytes(PROCESS_NAME, self.process_names[pid])
+            return field_bytes(TRACK_PROCESS, process)
+        return self.track(('process', pid), descriptor)
+
+    def thread_track(self, pid, tid):
+        def descriptor(uuid):
+            thread = field_varint(THREAD_PID, pid) + field_varint(THREAD_TID, tid)
+            if (pid, tid) in self.thread_names:
+                thread += field_bytes(THREAD_NAME, self.thread_names[(pid, tid)])
+            return field_bytes(TRACK_THREAD, thread)
+        self.process_track(pid)
+        return self.track(('thread', pid, tid), descriptor)
+
+    def counter_track(self, pid, name):
+        parent = self.process_track(pid)
+        def descriptor(uuid):
+            return field_varint(TRACK_PARENT_UUID, parent) + field_bytes(TRACK_NAME, name) + field_bytes(TRACK_COUNTER, b"")
+        return self.track(('counter', pid, name), descriptor)
+
+    def track_event(self, ts, track, tp, name=None, value=None):
+        """ ts is in us, like in the chrome format """
+        event = field_varint(EVENT_TYPE, tp) + field_varint(EVENT_TRACK_UUID, track)
+        packet = field_varint(PACKET_TIMESTAMP, round(ts * 1000)) + field_varint(PACKET_SEQUENCE_ID, SEQUENCE_ID)
+
+        if name is not None:
+            # every name is only written once per sequence, afterwards it is referenced by its iid
+            iid = self.names.get(name)
+            if iid is None:
+                iid = self.names[name] = len(self.names) + 1
+                entry = field_varint(EVENT_NAME_IID_FIELD, iid) + field_bytes(EVENT_NAME_NAME, name)
+                packet += field_bytes(PACKET_INTERNED_DATA, field_bytes(INTERNED_EVENT_NAMES, entry))
+            event += field_varint(EVENT_NAME_IID, iid)
+        if value is not None:
+            event += field_double(EVENT_DOUBLE_COUNTER_VALUE, value)
+
+        if self.first:
+            packet += field_varint(PACKET_SEQUENCE_FLAGS, SEQ_INCREMENTAL_STATE_CLEARED)
+            self.first = False
+        else:
+            packet += field_varint(PACKET_SEQUENCE_FLAGS, SEQ_NEEDS_INCREMENTAL_STATE)
+        self.packet(packet + field_bytes(PACKET_TRACK_EVENT, event))
+
+
+def write_perfetto_trace(events, filename):
+    """ writes a list of chrome trace events as perfetto protobuf trace. Returns number of skipped events """
+
+    # metadata events name processes and threads, we need those before emitting any track
+    process_names = {}
+    thread_names = {}
+    for e in events:
+        if e['ph'] == 'M' and 'args' in e:
+            if e['name'] == 'process_name':
+                process_names[e['pid']] = e['args']['name']
+            elif e['name'] == 'thread_name':
+                thread_names[(e['pid'], e.get('tid', e['pid']))] = e['args']['name']
+
+    skipped = 0
+    with open(filename, 'wb', buffering=1<<20) as f:
+        w = PerfettoWriter(f, process_names, thread_names)
+        for e in events:
+            ph = e['ph']
+            ts = e.get('ts')
+            if ph == 'M':
+                continue
+            if ts is None or ts < 0:
+                # perfetto timestamps are unsigned
+                skipped += 1
+                continue
+
+            pid = e.get('pid', 0)
+            if ph == 'C':
+                for key, value in e.get('args', {}).items():
+                    w.track_event(ts, w.counter_track(pid, key), TYPE_COUNTER, value=float(value))
+                continue
+
+            track = w.thread_track(pid, e.get('tid', pid))
+            if ph == 'B':
+                w.track_event(ts, track, TYPE_SLICE_BEGIN, e['name'])
+            elif ph == 'E':
+                w.track_event(ts, track, TYPE_SLICE_END)
+            elif ph == 'X':
+                w.track_event(ts, track, TYPE_SLICE_BEGIN, e['name'])
+                w.track_event(ts + e.get('dur', 0), track, TYPE_SLICE_END)
+            elif ph in ('i', 'I'):
+                w.track_event(ts, track, TYPE_INSTANT, e['name'])
+            else:
+                skipped += 1
+
+    return skipped